@@ -1,12 +1,13 @@
 #!/usr/bin/env python
 
 import sys, os
+import io, csv, mmap
 import string
 
 import numpy as np
 import pandas as pd
 
-import datetime as dt
+from numba import njit, prange, types
 
 import sqlite3 as sq
 
@@ -15,13 +16,23 @@ import sqlite3 as sq
 # Functions to check FIGI Digit
 ####################################
 
-## Map used by checkFIGIDigit function validating checkDigit on FIGI identifiers
+## Lookup tables used by checkFIGIDigit function validating checkDigit on FIGI identifiers
+## figiValLUT maps a character code to its numeric value (0 = 0, ... , 9 = 9, A = 10, ... , Z = 35)
+##            any other character maps to figiInvalidVal
+## figiDigitSumLUT / figiDoubleDigitSumLUT map a numeric value n to the sum of digits of n / 2*n
+## All tables are 256 long so they can be applied with bytes.translate
 
-figiAlphaNumMap = dict(zip([chr(v) for v in range(65,65+26)], range(10, 36)))
+figiInvalidVal = 255
 
-## sum of all digits of a given number in one pass
-def digitSum(x):
-    return ( sum(map(int,str(x))) )
+figiValLUT = bytearray([figiInvalidVal] * 256)
+for v, ch in enumerate(string.digits + string.ascii_uppercase):
+    figiValLUT[ord(ch)] = v
+figiValLUT = bytes(figiValLUT)
+
+# values are at most 35 (70 doubled), below 100 the digit sum is tens + units
+
+figiDigitSumLUT = bytes([n // 10 + n % 10 for n in range(36)] + [0] * 220)
+figiDoubleDigitSumLUT = bytes([(2 * n) // 10 + (2 * n) % 10 for n in range(36)] + [0] * 220)
 
 
 ## checkdigit on the full 12 digit figi string
@@ -34,13 +45,11 @@ def checkFIGIDigit(figi):
 
     if len(figi) != 12: return False
 
-    if not figi.isalnum(): return False
+    checkDigit = figi[11]
+    vals = figi.encode('ascii', 'replace')[:11].translate(figiValLUT)
+    if figiInvalidVal in vals: return False
 
-    checkDigit = figi[len(figi)-1]
-    figi11 = figi[:-1:] if len(figi) == 12 else figi
-    xx = [figiAlphaNumMap[ch] if ch.isalpha() else int(ch) for ch in figi11 ]
-    yy = [xx[i]*2 if i % 2 == 1 else xx[i] for i in range(len(xx))]
-    zz = sum(map(digitSum, yy))
+    zz = sum(vals[0::2].translate(figiDigitSumLUT)) + sum(vals[1::2].translate(figiDoubleDigitSumLUT))
     tmp = (10-zz)%10
 
     return str(tmp) == checkDigit
@@ -48,11 +57,95 @@ def checkFIGIDigit(figi):
 ## end __checkFIGIDigit
 
 
+## compiled checkdigit over a batch of figis, one row of 12 ascii codes per figi, same algo as checkFIGIDigit
+## rows are validated in parallel, the per character steps are kept branch free so they vectorize
+## the argument is typed read only so a view over bytes (read only) or a bytearray is passed without a copy
+
+@njit(types.boolean[:](types.Array(types.uint8, 2, 'C', readonly=True)), parallel=True, cache=True)
+def _checkFIGIDigitNbBatch(arr):
+
+    n = arr.shape[0]
+    out = np.empty(n, dtype=np.bool_)
+
+    for i in prange(n):
+        zz = 0
+        ok = True
+        for j in range(11):
+            c = arr[i, j]
+            ok = ok & (((c >= 48) & (c <= 57)) | ((c >= 65) & (c <= 90)))
+            # convert alphabets to numeric (A = 10, ... , Z = 35), multiply every second number by 2
+            x = (c - 48 - 7 * (c >= 65)) * (1 + (j & 1))
+            # all values are below 100, digit sum is tens + units
+            zz += x // 10 + x % 10
+        out[i] = ok & ((10 - zz % 10) % 10 == arr[i, 11] - 48)
+
+    return out
+
+
+## pack figi strings into one buffer of 12 ascii codes per figi, figi i is figiBuf[12*i:12*(i+1)]
+## figis that are not 12 characters long are packed as zeros (never valid), non ascii characters as '?'
+## the buffer is only the validation input, the figi column itself stays as strings (it is what goes into the db)
+
+def packFIGIs(figis):
+    return ''.join([figi if len(figi) == 12 else '\0' * 12 for figi in figis]).encode('ascii', 'replace')
+
+
+## checkdigit over a batch of figis packed by packFIGIs, returns a boolean array, one entry per figi
+## figiBuf (bytes or bytearray) is used in place without a copy
+
+def checkFIGIDigitBatch(figiBuf):
+
+    arr = np.frombuffer(figiBuf, dtype=np.uint8).reshape(-1, 12)
+    return _checkFIGIDigitNbBatch(arr)
+
+## end __checkFIGIDigitBatch
+
+
+## compiled check that every non blank line of a data section (ascii codes) has exactly nsep '|' separators
+## blank lines are skipped as read_csv skips them. Compiled lazily so read only buffers can be passed
+
+@njit(cache=True)
+def _checkRowSeparators(buf, nsep):
+
+    count = 0
+    blank = True
+    for c in buf:
+        if c == 10:
+            if not blank and count != nsep: return False
+            count = 0
+            blank = True
+        elif c == 124:
+            count += 1
+            blank = False
+        elif c != 13 and c != 32 and c != 9:
+            blank = False
+
+    return blank or count == nsep
+
+
+## offset of the first line at or after start (a line start) reading marker once stripped,
+## the same match the line state machine in BbgDataFile.parseFileText uses. len(buf) if there is none
+
+def findMarkerLine(buf, marker, start):
+
+    i = buf.find(marker, start)
+    while i >= 0:
+        lineStart = buf.rfind(b'\n', start, i) + 1 or start
+        lineEnd = buf.find(b'\n', i)
+        if lineEnd < 0: lineEnd = len(buf)
+        if not buf[lineStart:i].strip() and not buf[i + len(marker):lineEnd].strip():
+            return lineStart
+        i = buf.find(marker, i + 1)
+
+    return len(buf)
+
+
 ####################################
 # Class to represent a Bbg data file
 # Assumes basic structure like following fields are mandatory:
 # START-OF-FILE , START-OF-FIELDS, END-OF-FIELDS, START-OF-DATA, END-OF-DATA
 # Provides basic interfacing functions
+# Data rows are held column-wise in a pandas DataFrame (string values, one column per field)
 # Does almost no data cleaning apart from FIGI check digit validation
 # Data cleaning left to user of class
 ####################################
@@ -62,14 +155,22 @@ class BbgDataFile:
 
     def __init__(self, fname):
     
-        fchannel = open(fname)
-        lines = fchannel.readlines()
-        
-        fields, dataList = self.parseFileText(lines)
+        # map the file instead of reading it, the parser slices the sections it needs out of the mapping
+        with open(fname, 'rb') as fchannel:
+            try:
+                buf = mmap.mmap(fchannel.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # empty file cannot be mapped
+                buf = b''
+            try:
+                fields, data = self.parseFileText(buf)
+            finally:
+                if isinstance(buf, mmap.mmap): buf.close()
     
         self.fields = fields
-        self.dataList = dataList
-        self.nrows = len(dataList)
+        self.fieldsLoc = dict(zip(fields, range(len(fields) ) ) )
+        self.data = data
+        self.nrows = len(data)
         
     ## end __init__
     
@@ -77,35 +178,46 @@ class BbgDataFile:
     def getFields(self):
         return self.fields        
     
-    # get actual dataset
+    # get actual dataset, one tuple per row with values ordered like fields
     def getDataList(self):
-        return self.dataList
+        return list(self.data.itertuples(index=False, name=None))
+
+    # get actual dataset as a DataFrame, one column per field
+    def getDataFrame(self):
+        return self.data
     
     # get size of dataset
     def nrows(self):
         return self.nrows
     
-    # data retrieve function that gets data for all rows for said columns
-    def getDataForFields(self, columns ):
+    # data retrieve function that gets data for all rows for said columns, as a DataFrame
+    def getDataFrameForFields(self, columns ):
    
-        goodFields = [True if f in self.fields else False for f in columns]
-        if not all(goodFields):
-            raise Exception('Data not available for following fields in bbg data file:' + 
-                            [ columns[i] for i in range(len(columns)) if not goodFields[i] ]) 
+        badFields = [f for f in columns if f not in self.fieldsLoc]
+        if badFields:
+            raise Exception('Data not available for following fields in bbg data file: ' + 
+                            ', '.join(badFields)) 
 
-        outData = [ [row[k] for k in columns] for row in self.dataList]
+        # columns are ordered like self.fields
+        idxs = [self.fieldsLoc[f] for f in columns]
+        return self.data.iloc[:, idxs]
 
-        return outData
+    # data retrieve function that gets data for all rows for said columns
+    def getDataForFields(self, columns ):
+
+        return self.getDataFrameForFields(columns).values.tolist()
     
 
 
     
-    def parseFileText(self, lines):
+    def parseFileText(self, buf):
                     
         fields = list()
-        fieldsLoc = dict()
-        dataList = list()
-        dataDict = dict()
+        dataFrames = list()
+
+        # header / footer lines are decoded one at a time and go through the line state machine below
+        # on START-OF-DATA the rows up to the matching END-OF-DATA line are handed to parseDataSection
+        # as one block and the walk resumes on the END-OF-DATA line
 
         # state starts with -1 by default
         # state is set to 0 after basic file structure validation
@@ -114,58 +226,46 @@ class BbgDataFile:
         
         state = -1
 
-        for line in lines:
-            line = line.strip()
+        fields_append = fields.append
 
-            if state == -1 and line == 'START-OF-FILE':
-                state = 0
-                continue
-            
-            if state == 0:
+        pos = 0
+        while pos < len(buf):
+            lineEnd = buf.find(b'\n', pos)
+            if lineEnd < 0: lineEnd = len(buf)
+            line = buf[pos:lineEnd].decode().strip()
+            pos = lineEnd + 1
+
+            if state == 2:
+                if line == 'END-OF-DATA':
+                    #print(sum(map(len, dataFrames)))
+                    state = 0
+
+            elif state == 1:
+                if line == 'END-OF-FIELDS':
+                    state = 0
+                else:
+                    fields_append(line)
+
+            elif state == 0:
                 if line == 'START-OF-FIELDS':
                     state = 1
-                    continue
                 elif line == 'START-OF-DATA':
+                    dataEnd = findMarkerLine(buf, b'END-OF-DATA', pos)
+                    dataFrames.append(self.parseDataSection(buf[pos:dataEnd], fields))
+                    pos = dataEnd
                     state = 2
-                    continue
                 else:
-                    if 'DATARECORD' in line:
-                        nrow = int(line.split('=')[1])
-                        if nrow != len(dataList):
+                    if line.startswith('DATARECORD'):
+                        nrow = int(line.split('=', 1)[1])
+                        if nrow != sum(map(len, dataFrames)):
                             print('WARNING: Not all data rows loaded successfully from bbg file')
                             # Could be an Exception depending on how we want to handle this
                     # TODO
                     # Other things you want to do for lines outside of FIELDS or DATA ROWS
                     # set programm name, date format etc
-                    continue
-
-            if state == 1:
-                if line == 'END-OF-FIELDS':
-                    fieldsLoc = dict(zip(fields, range(len(fields) ) ) )
-                    #print(fieldsLoc)
-                    state = 0
-                    continue
-                else:
-                    fields.append(line)
 
-            if state == 2:
-                if line == 'END-OF-DATA':
-                    #print(len(dataList))
-                    state = 0
-                    continue
-                else:
-                    data = line.split('|')[3:]
-                    datarow = data[0:(len(data)-1)]
-                    if len(datarow) != len(fields):
-                        raise Exception('Insufficient values found in row')
-                    figi = datarow[-1]
-                    checkDigitValid = checkFIGIDigit(figi)
-                    if (not checkDigitValid):
-                        print('FIGI check digit invalid, skipping line for ID_BB_GLOBAL: ' + figi )
-                        continue
-                    datarow = dict(zip(fields, datarow))
-                    dataList.append(datarow)
-                    dataDict[figi] = datarow
+            elif line == 'START-OF-FILE':
+                state = 0
 
         if (state == -1):
             raise Exception('File Structure Invalid. Could not find START-OF-FILE')
@@ -173,221 +273,254 @@ class BbgDataFile:
         if (state != 0):
             raise Exception('File Structure Invalid. File does not end gracefully')
 
-        return( (fields, dataList) )
+        if dataFrames:
+            data = pd.concat(dataFrames, ignore_index=True)
+        else:
+            data = pd.DataFrame(columns=fields, dtype=str)
+
+        return( (fields, data) )
+
+
+    # parse the pipe delimited data section (bytes) in one pass with the pandas C parser
+    # each row is: security|return code|number of fields|value 1|...|value n|
+    # returns a DataFrame with one column per field, rows with invalid FIGI check digit are dropped
+    def parseDataSection(self, text, fields):
+
+        if not text or text.isspace(): return pd.DataFrame(columns=fields, dtype=str)
+
+        ncols = len(fields)
+        df = pd.read_csv(io.BytesIO(text), sep='|', header=None, names=range(ncols + 4),
+                         usecols=range(3, ncols + 3), index_col=False, dtype=str,
+                         keep_default_na=False, quoting=csv.QUOTE_NONE, engine='c')
+
+        # read_csv pads short rows and may cut long ones, so check every row had exactly ncols + 3 separators
+        if not _checkRowSeparators(np.frombuffer(text, dtype=np.uint8), ncols + 3):
+            raise Exception('Insufficient values found in row')
+
+        # validate FIGI check digit for all rows in one pass
+        figis = df[ncols + 2].to_numpy()
+        checkDigitValid = checkFIGIDigitBatch(packFIGIs(figis))
+        for figi in figis[~checkDigitValid]:
+            print('FIGI check digit invalid, skipping line for ID_BB_GLOBAL: ' + figi )
+
+        df = df[checkDigitValid].reset_index(drop=True)
+        df.columns = fields
+        return df
 
     
 
 # Basic data cleaning functions to handle empty strings, N.A. strings
 # Used just before preparing data to enter into database
+# Work on a whole column (pandas Series) at once, missing values become NaN
 
-def cleanVal(val):
-    val = val.strip()
-    if val == '' or val == 'N.A.':
-        return 'NULL'
-    else:
-        return val
+def cleanVal(vals):
+    vals = vals.str.strip()
+    return vals.mask(vals.isin(['', 'N.A.']))
 
-def cleanDate(dtstr):
-    dtstr = dtstr.strip()
-    if (dtstr == '' or dtstr == 'N.A.'):
-        return 'NULL'
-    else: 
-        return format(dt.datetime.strptime(dtstr, '%Y%m%d'), '%Y-%m-%d')
+def cleanDate(dtstrs):
+    dtstrs = cleanVal(dtstrs)
+    return pd.to_datetime(dtstrs, format='%Y%m%d').dt.strftime('%Y-%m-%d')
+
+# Calculate YTW on cleaned price columns: lowest of yield to call / yield to maturity (compared as numbers)
+# with its date, call wins a tie. Non numeric yields (e.g. N.S.) only lose the comparison, the original
+# values are kept for the insert. Returns (ytw, ytw date) columns
+def calcYTW(ytm, maturity, ytc, call_dt):
+    ytmNum = pd.to_numeric(ytm, errors='coerce')
+    ytcNum = pd.to_numeric(ytc, errors='coerce')
+    useYtm = ytcNum.isna() | (ytmNum < ytcNum)
+    ytw = ytc.where(~useYtm, ytm)
+    ytw_dt = call_dt.where(~useYtm, maturity).where(ytw.notna())
+    return ytw, ytw_dt
 
 
 
 ##############################
-# update Pref Static Data function
-# Inputs are the bbg object, and the database path,
-# Given the above, retrieve data from bbg data object based on definition defined in function (could be moved to config)
-# Cleans the data and  enters  into database
+# Row generators feeding executemany
+# Rows are produced one at a time from the cleaned DataFrame so no list of insert tuples is built
 ##############################
 
-def updatePrefStatic(bbgdata, dbpath) :
+# Rows of a cleaned DataFrame with missing values as None, which sqlite binds as NULL
+def _dbRows(df):
+    return df.astype(object).where(df.notna(), None).itertuples(index=False, name=None)
 
-    print()
-    print('Updating DB with Pref Static data')
-    
-    if not os.path.isfile(dbpath):
-        print('Cannot find specified perf db:' + dbpath)
-        print('New one will be created')
 
-    # Open db if exists or create new one
-    conn = sq.connect(dbpath)
-    dbcur = conn.cursor()
-    
-    
+##############################
+# Open (or create) the sqlite db for a bulk load
+# Autocommit mode (isolation_level=None) so transactions are controlled explicitly with BEGIN / COMMIT
+# WAL journal, no fsync and in memory temp store: the load can simply be re-run if the machine dies mid way
+##############################
 
-    ## configs for static table    
-    
-    tableName = 'PrefStatic'
+def connectDb(dbpath):
+
+    conn = sq.connect(dbpath, isolation_level=None)
+
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=OFF')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA cache_size=-65536')
+
+    return conn
+
+
+##############################
+# configs for static table
+# Fetched from bbg data file and entered into PrefStatic
+# SQL is built once at load so every call reuses the same statement text (and sqlite statement cache entry)
+##############################
+
+prefStaticTable = 'PrefStatic'
 
-    # Fields to be retrieved from bloomberg data file
+# Fields to be retrieved from bloomberg data file
 
-    prefStaticFields  = ['ID_BB_GLOBAL',
-                         'NAME',
-                         'CRNCY',
-                         'CPN']
+prefStaticFields  = ['ID_BB_GLOBAL',
+                     'NAME',
+                     'CRNCY',
+                     'CPN']
 
-    # Column headers that will be entered into database
+# Column headers that will be entered into database
 
-    columnHeaders = ['FIGI',
-                      'Name',
-                      'Currency',
-                      'Coupon']
+prefStaticColumns = ['FIGI',
+                     'Name',
+                     'Currency',
+                     'Coupon']
 
-    # Must match size of columnHeaders. Used when table is created.
+# Must match size of prefStaticColumns. Used when table is created.
 
-    headerTypes = {'FIGI' : 'TEXT',
-                   'Name' : 'TEXT',
-                   'Currency' : 'TEXT',
-                   'Coupon': 'REAL'}
+prefStaticHeaderTypes = {'FIGI' : 'TEXT',
+                         'Name' : 'TEXT',
+                         'Currency' : 'TEXT',
+                         'Coupon': 'REAL'}
 
-    create_table_sql = """CREATE TABLE IF NOT EXISTS """ + tableName + " (" + \
-                         ", ".join([ " ".join([header, headerTypes[header]]) for header in columnHeaders ]) + ")"  
+# CREATE TABLE IF NOT EXISTS PrefStatic (FIGI TEXT, Name TEXT, Currency TEXT, Coupon REAL)
+
+CREATE_STATIC_SQL = """CREATE TABLE IF NOT EXISTS """ + prefStaticTable + " (" + \
+                    ", ".join([ " ".join([header, prefStaticHeaderTypes[header]]) for header in prefStaticColumns ]) + ")"
+
+INSERT_STATIC_SQL = """INSERT INTO """ + prefStaticTable + """ VALUES (""" + ",".join(['?' for x in prefStaticColumns]) + """) """
+
+
+##############################
+# update Pref Static Data function
+# Inputs are the bbg object, and an open db connection (see connectDb),
+# Given the above, retrieve data from bbg data object based on the static table configs
+# Cleans the data and  enters  into database
+# Transaction handling is left to the caller
+##############################
+
+def updatePrefStatic(bbgdata, conn) :
+
+    print()
+    print('Updating DB with Pref Static data')
     
-    # CREATE TABLE IF NOT EXISTS PrefStatic (FIGI TEXT, Name TEXT, Currency TEXT, Coupon REAL)
+    dbcur = conn.cursor()
     
-    dbcur.execute(create_table_sql)
+    dbcur.execute(CREATE_STATIC_SQL)
     
 
     # Fetch static data from bbg data file
 
     print('Retrieving prefs Static Data from bbg object')
 
-    prefStaticData = bbgdata.getDataForFields(columns = prefStaticFields)
+    prefStaticData = bbgdata.getDataFrameForFields(columns = prefStaticFields).set_axis(prefStaticColumns, axis = 1)
 
+    print(str(len(prefStaticData)) + ' rows found')
+        
     # Clean data (change missing or empty values to NULL, any other claculations)
-    prefStaticDataInsert = [ tuple([cleanVal(x) for x in row]) for row in prefStaticData ]
+    prefStaticData = prefStaticData.apply(cleanVal)
 
-    print(str(len(prefStaticDataInsert)) + ' rows found')
-        
-    insert_static_sql = """INSERT INTO """ + tableName + """ VALUES (""" + ",".join(['?' for x in columnHeaders]) + """) """
-    
-    dbcur.executemany(insert_static_sql,  prefStaticDataInsert) 
-    
-    print('Inserted ' + str(len(prefStaticDataInsert)) + ' rows into PrefStatic Table')
+    dbcur.executemany(INSERT_STATIC_SQL,  _dbRows(prefStaticData)) 
     
-    print('Committing new data')
-    conn.commit()
+    print('Inserted ' + str(dbcur.rowcount) + ' rows into PrefStatic Table')
     
-    conn.close()
+    dbcur.close()
 
 
 
+##############################
+# configs for price table
+# Fetched from bbg data file, cleaned, YTW calculated and entered into PrefPrice
+##############################
+
+prefPriceTable = 'PrefPrice'
+
+prefPriceFields  = ['ID_BB_GLOBAL', 
+                    'PX_CLOSE_DT',
+                    'PX_LAST',
+                    'YLD_YTM_MID',
+                    'MATURITY',
+                    'YLD_YTC_MID',
+                    'NXT_CALL_DT']
+
+prefPriceColumns = ['EquityId',
+                    'Date',
+                    'Price',
+                    'YieldToMaturity',
+                    'ConventionalYieldTW',
+                    'WorstDate']
+
+prefPriceHeaderTypes = {'EquityId' : 'TEXT',
+                        'Date' : 'TEXT',
+                        'Price' : 'REAL',
+                        'YieldToMaturity' : 'REAL',
+                        'ConventionalYieldTW' : 'REAL',
+                        'WorstDate' : 'TEXT'}
+
+# CREATE TABLE IF NOT EXISTS PrefPrice 
+# (EquityId TEXT, Date TEXT, Price REAL, YieldToMaturity REAL, ConventionalYieldTW REAL, WorstDate TEXT,
+# FOREIGN KEY (EquityId) REFERENCES PrefStatic(FIGI) )
+
+CREATE_PRICE_SQL = """CREATE TABLE IF NOT EXISTS """ + prefPriceTable + " (" + \
+                   ", ".join([ " ".join([header, prefPriceHeaderTypes[header]]) for header in prefPriceColumns ]) + "," + \
+                   """ FOREIGN KEY (EquityId) REFERENCES PrefStatic(FIGI) )"""
+
+INSERT_PRICE_SQL = """INSERT INTO """ + prefPriceTable + """ VALUES (""" + ",".join(['?' for x in prefPriceColumns]) + """) """
+
+
 ##############################
 # update Pref Price Data function
-# Inputs are the bbg object, and the database path,
-# Given the above, retrieve data from bbg data object based on definition defined in function (could be moved to config)
+# Inputs are the bbg object, and an open db connection (see connectDb),
+# Given the above, retrieve data from bbg data object based on the price table configs
 # Cleans the data and  enters  into database
+# Transaction handling is left to the caller
 ##############################
 
 
 
-def updatePrefPrice(bbgdata, dbpath) :
+def updatePrefPrice(bbgdata, conn) :
 
     print()
     print('Updating DB with Pref Price data')
     
-    if not os.path.isfile(dbpath):
-        print('Cannot find specified perf db:' + dbpath)
-        print('New one will be created')
-        
-
-    # Open db if exists or create new one
-    conn = sq.connect(dbpath)
     dbcur = conn.cursor()
     
-    
-    ## configs for price table
-    
-    tableName = 'PrefPrice'
-
-    prefPriceFields  = ['ID_BB_GLOBAL', 
-                        'PX_CLOSE_DT',
-                        'PX_LAST',
-                        'YLD_YTM_MID',
-                        'MATURITY',
-                        'YLD_YTC_MID',
-                        'NXT_CALL_DT']
-
-    columnHeaders = ['EquityId',
-                     'Date',
-                     'Price',
-                     'YieldToMaturity',
-                     'ConventionalYieldTW',
-                     'WorstDate']
-
-    headerTypes = {'EquityId' : 'TEXT',
-                   'Date' : 'TEXT',
-                   'Price' : 'REAL',
-                   'YieldToMaturity' : 'REAL',
-                   'ConventionalYieldTW' : 'REAL',
-                   'WorstDate' : 'TEXT'}
-
-
-    create_table_sql = """CREATE TABLE IF NOT EXISTS """ + tableName + " (" + \
-                        ", ".join([ " ".join([header, headerTypes[header]]) for header in columnHeaders ]) + "," + \
-                        """ FOREIGN KEY (EquityId) REFERENCES PrefStatic(FIGI) )"""    
-
-    # create_table_sql = 
-    # "CREATE TABLE IF NOT EXISTS PrefPrice 
-    # (EquityId TEXT, Date TEXT, Price REAL, YieldToMaturity REAL, ConventionalYieldTW REAL, WorstDate TEXT,
-    # FOREIGN KEY (EquityId) REFERENCES PrefStatic(FIGI) )"
-
-    dbcur.execute(create_table_sql)
+    dbcur.execute(CREATE_PRICE_SQL)
     
 
     # Get pref Price Data, clean, 
 
-    prefPriceData = bbgdata.getDataForFields(columns = prefPriceFields)
-
+    prefPriceData = bbgdata.getDataFrameForFields(columns = prefPriceFields).copy()
 
     # Clean data ( convert empty and missing to NULL, change date format , calculate YTW)
-    
-    prefPriceDataInsert = list()
-    for row in prefPriceData:
-        equityid = row[0]
-        px_dt    = cleanDate(row[1])
-        px       = cleanVal(row[2])
-        ytm      = cleanVal(row[3])
-        maturity = cleanDate(row[4])
-        ytc      = cleanVal(row[5])
-        call_dt  = cleanDate(row[6])
-        ytw      = 'NULL'
-        ytw_dt   = 'NULL'
-        if not ytm == 'NULL' and not ytc == 'NULL':
-            if (ytm < ytc):
-                ytw = ytm
-                ytw_dt = maturity
-            else:
-                ytw = ytc
-                ytw_dt = call_dt
-        else:
-            if not ytm == 'NULL':
-                ytw = ytm
-                ytw_dt = maturity
-            else:
-                ytw = ytc
-                ytw_dt = call_dt
-        
-        prefPriceDataInsert.append( tuple([equityid, px_dt, px, ytm, ytw, ytw_dt]))
 
+    for f in ['PX_CLOSE_DT', 'MATURITY', 'NXT_CALL_DT']:
+        prefPriceData[f] = cleanDate(prefPriceData[f])
 
-    print(str(len(prefPriceDataInsert)) + ' rows found')
+    for f in ['PX_LAST', 'YLD_YTM_MID', 'YLD_YTC_MID']:
+        prefPriceData[f] = cleanVal(prefPriceData[f])
 
-    # Insert data into database
- 
-    insert_static_sql = """INSERT INTO """ + tableName + """ VALUES (""" + ",".join(['?' for x in columnHeaders]) + """) """
-    
-    dbcur.executemany(insert_static_sql,  prefPriceDataInsert) 
+    prefPriceData['YTW'], prefPriceData['YTW_DT'] = calcYTW(prefPriceData['YLD_YTM_MID'], prefPriceData['MATURITY'],
+                                                            prefPriceData['YLD_YTC_MID'], prefPriceData['NXT_CALL_DT'])
+
+    print(str(len(prefPriceData)) + ' rows found')
+
+    # Insert data into database, columns in prefPriceColumns order
     
-    print('Inserted ' + str(len(prefPriceDataInsert)) + ' rows into PrefPriceData Table')
+    prefPriceInsert = prefPriceData[['ID_BB_GLOBAL', 'PX_CLOSE_DT', 'PX_LAST', 'YLD_YTM_MID', 'YTW', 'YTW_DT']]
+    dbcur.executemany(INSERT_PRICE_SQL,  _dbRows(prefPriceInsert)) 
     
-    print('Committing new data')
-    conn.commit()
+    print('Inserted ' + str(dbcur.rowcount) + ' rows into PrefPriceData Table')
     
-    conn.close()
+    dbcur.close()
  
 
 ########################
@@ -398,9 +531,12 @@ def updatePrefPrice(bbgdata, dbpath) :
 #bbgdata = BbgDataFile(bbgfname)
 
 #dbpath = 'datadb.db'
+#conn = connectDb(dbpath)
 
-#updatePrefStatic(bbgdata, dbpath = dbpath)
-#updatePrefPrice(bbgdata, dbpath = dbpath)
+#conn.execute('BEGIN IMMEDIATE')
+#updatePrefStatic(bbgdata, conn)
+#updatePrefPrice(bbgdata, conn)
+#conn.execute('COMMIT')
 
 
 
@@ -438,15 +574,32 @@ def main():
     # Get Prefs data and load into DB
     ######
     
+    if not os.path.isfile(dbpath):
+        print('Cannot find specified perf db:' + dbpath)
+        print('New one will be created')
+
+    # Open db if exists or create new one, shared by both updates which load in one transaction
+    conn = connectDb(dbpath)
+
     try:
 
-        status = updatePrefStatic(bbgdata, dbpath = dbpath)
+        conn.execute('BEGIN IMMEDIATE')
+
+        status = updatePrefStatic(bbgdata, conn)
     
-        status = updatePrefPrice(bbgdata, dbpath = dbpath)
+        status = updatePrefPrice(bbgdata, conn)
+
+        print('Committing new data')
+        conn.execute('COMMIT')
 
     except sq.Error as er:
-        print er
-	raise er
+        print(er)
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        raise
+
+    finally:
+        conn.close()
 
     print('done')
            